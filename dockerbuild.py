@@ -1,10 +1,23 @@
 import os
+import io
+import functools
 import json
+import queue
 import re
 import docker
 import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+try:
+    import orjson  # 可选依赖: 比标准库 json 更快的解析器
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 # ==================== 配置区域 ====================
 TASKS_DIR = Path(r"INSTANCE_DIR")
 IMAGE_NAME_TEMPLATE = "swebench/sweb.eval.x86_64.INSTANCE_DIR"
@@ -13,10 +26,119 @@ IMAGE_NAME_TEMPLATE = "swebench/sweb.eval.x86_64.INSTANCE_DIR"
 FORCE_REBUILD = False  # 是否强制重新构建已存在的镜像
 SKIP_EXISTING = True   # 是否跳过已存在的镜像
 EXIT_ON_FAILURE = True # 如果为 True，构建失败时立即终止程序
+MAX_WORKERS = min(os.cpu_count() or 1, 4)  # 并行构建的镜像数量上限，避免压垮小型主机
+# 是否将同仓库其他 PR 的镜像作为 cache_from 传给构建。
+# 注意: 经典构建器在指定 cache_from 后，只接受位于这些镜像祖先链上的本地缓存层，
+# 镜像自身上次构建失败时遗留的中间层将不再被复用 (未与同仓库镜像共享的步骤会全部重新执行)。
+# 重试此前中途失败的构建时，可设为 False 以复用这些本地缓存层。
+CACHE_FROM_SIBLINGS = True
+SCAN_CACHE_FILE = "_scan_cache.json"  # 任务目录下的扫描缓存: 文件路径 -> (mtime, size, instance_id)
+ERROR_LOG = Path(__file__).resolve().parent / "errors.log"  # 未知错误的完整堆栈追加到此文件
+
+SEPARATOR = "=" * 60
+
+# 实时输出构建日志的节奏: 缓冲区超过该大小或距上次输出超过该时间即写出 (构建暂无输出时同样按时写出)
+LOG_FLUSH_BYTES = 64 * 1024
+LOG_FLUSH_INTERVAL = 0.1  # 秒
+LOG_QUEUE_SIZE = 1024  # 读取线程与写出之间最多积压的日志条数
+
+# instance_id 格式: {owner}__{repo}-{pr_id}
+# owner 取第一个 '__' 之前的部分，pr_id 取最后一个 '-' 之后的纯数字部分
+_INSTANCE_RE = re.compile(r"(.*?)__(.*)-(\d+)", re.S)
+
+
+@functools.lru_cache(maxsize=4096)
+def _split_instance_id(instance_id: str) -> tuple[str, str, str] | None:
+    """解析 instance_id 为 (owner, repo, pr_id)，owner 和 repo 转为小写；无法解析时返回 None"""
+    m = _INSTANCE_RE.fullmatch(instance_id)
+    if m is None:
+        return None
+    owner, repo_name, pr_id = m.groups()
+    return owner.lower(), repo_name.lower(), pr_id
+
+
+@functools.lru_cache(maxsize=4096)
+def _image_name_for(repo_owner: str, repo_name: str, pr_id: str) -> str:
+    """根据 IMAGE_NAME_TEMPLATE 生成镜像名称 (同一任务的多个 JSON 只格式化一次)"""
+    return IMAGE_NAME_TEMPLATE.format(repo_owner=repo_owner, repo_name=repo_name, pr_id=pr_id)
+
+
+def _iter_with_idle_ticks(iterable, interval: float, maxsize: int = LOG_QUEUE_SIZE):
+    """
+    在后台线程中迭代 iterable 并逐个产出其元素；超过 interval 秒没有新元素时产出 None，
+    便于调用方在输出停顿期间也能按时写出已缓冲的日志。
+    调用方提前结束迭代 (异常或 break) 时通知后台线程停止，后台线程不会阻塞在已满的队列上。
+    """
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    end = object()  # 结束标记
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=interval)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def pump():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((end, e))
+            return
+        put((end, None))
+
+    threading.Thread(target=pump, daemon=True).start()
+    try:
+        while True:
+            try:
+                item, error = items.get(timeout=interval)
+            except queue.Empty:
+                yield None
+                continue
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def _iter_task_json_files(root: str):
+    """
+    基于 os.scandir 的迭代式目录遍历，逐个返回任务 JSON 文件的 DirEntry。
+    不跟随目录符号链接 (与 Path.rglob 一致)，并直接过滤掉结果文件和扫描缓存。
+    """
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.endswith(".json") and entry.name not in ("result.json", SCAN_CACHE_FILE):
+                        yield entry
+        except OSError:
+            continue
 
 
 class DockerImageBuilder:
-    def __init__(self):
+    def __init__(self, max_workers: int = MAX_WORKERS):
+        self.max_workers = max(1, max_workers)
+        # 同一时刻只有一个构建占用终端实时输出日志；占用期间其他日志 (扫描信息、其他构建的整段日志)
+        # 暂存到 _deferred_logs，待实时输出的构建结束后再依次写出，避免插入其日志流中
+        self._console_lock = threading.Lock()
+        self._live_build_active = False
+        self._deferred_logs: list[str] = []
+        self._log_lock = threading.Lock()
+        self._error_log_lock = threading.Lock()
+        self._tag_cache: set[str] | None = None
         try:
             self.client = docker.from_env()
             self.client.ping()
@@ -26,66 +148,167 @@ class DockerImageBuilder:
             print(f"   详细信息: {e}")
             exit(1)
 
-    def parse_instance_id(self, instance_id: str) -> dict | None:
+    def _log(self, text: str):
+        """线程安全地输出一段日志 (整段写出，避免并行构建时不同镜像的日志交错)"""
+        if not text:
+            return
+        with self._log_lock:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+    def _log_when_idle(self, text: str):
+        """终端未被实时输出的构建占用时立即输出，否则暂存到该构建结束后再输出"""
+        if not text:
+            return
+        with self._console_lock:
+            if self._live_build_active:
+                self._deferred_logs.append(text)
+                return
+            self._log(text)
+
+    def _acquire_live_output(self) -> bool:
+        """尝试占用终端实时输出日志，成功返回 True"""
+        with self._console_lock:
+            if self._live_build_active:
+                return False
+            self._live_build_active = True
+            return True
+
+    def _release_live_output(self):
+        """释放终端，并依次写出占用期间暂存的日志"""
+        with self._console_lock:
+            self._live_build_active = False
+            deferred, self._deferred_logs = self._deferred_logs, []
+            self._log("".join(deferred))
+
+    def _record_error(self, e: Exception, context: str) -> str:
+        """
+        将当前异常的完整堆栈追加到 ERROR_LOG，返回仅包含异常类型和消息的简短描述
+        (需在 except 块中调用)
+        """
         try:
-            # 1. 先从【最右边】切一刀，以 '-' 分隔。
-            # rsplit('-', 1) 表示从右往左切，只切 1 次。
-            # 这样无论 Repo 名字里有多少个 '-'，我们都能精准拿到最后的 PR ID
-            repo_part, pr_id = instance_id.rsplit('-', 1)
-            
-            # 验证切出来的 PR ID 是不是纯数字
-            if not pr_id.isdigit():
-                raise ValueError("PR ID 不是数字")
-
-            # 2. 再从【最左边】切一刀，以 '__' 分隔。
-            # split('__', 1) 表示从左往右切，只切 1 次。
-            # 这样无论 Repo 名字里有没有 '__'，我们都认为第一个 '__' 之前的是 Owner
-            owner, repo_name = repo_part.split('__', 1)
-
-            return {
-                "repo_owner": owner,
-                "repo_name": repo_name,
-                "pr_id": pr_id,
-            }
-        except ValueError:
-            # 如果分割失败（找不到 '-' 或 '__'），或者解包数量不对，会抛出 ValueError
+            with self._error_log_lock, open(ERROR_LOG, "a", encoding="utf-8") as f:
+                f.write(f"=== {context}\n")
+                traceback.print_exc(file=f)
+        except OSError:
+            pass
+        return "".join(traceback.format_exception_only(type(e), e)).strip()
+
+    def _flush_buffer(self, out: io.StringIO):
+        """写出缓冲区中已有的日志并清空缓冲区"""
+        self._log(out.getvalue())
+        out.seek(0)
+        out.truncate()
+
+    def parse_instance_id(self, instance_id: str) -> dict | None:
+        """解析 instance_id，返回的 repo_owner / repo_name 已转为小写"""
+        parts = _split_instance_id(instance_id)
+        if parts is None:
             print(f"⚠️ 警告: 无法解析 instance_id '{instance_id}'。格式严重不匹配。")
             return None
+        owner, repo_name, pr_id = parts
+        return {
+            "repo_owner": owner,
+            "repo_name": repo_name,
+            "pr_id": pr_id,
+        }
+
+    @staticmethod
+    def _normalize_tag(image_name: str) -> str:
+        """补全默认 tag，与 RepoTags 中的格式保持一致 (如 'a/b' -> 'a/b:latest')"""
+        if ":" in image_name.rsplit("/", 1)[-1]:
+            return image_name
+        return f"{image_name}:latest"
+
+    def _refresh_tag_cache(self):
+        """一次性拉取本地所有镜像的 tag，代替逐个镜像查询 Docker 服务"""
+        self._tag_cache = {
+            tag
+            for image in self.client.api.images()
+            for tag in (image.get("RepoTags") or [])
+        }
 
     def check_image_exists(self, image_name: str) -> bool:
-        """检查 Docker 镜像是否已存在"""
-        try:
-            self.client.images.get(image_name)
+        """
+        检查 Docker 镜像是否已存在
+        按 tag 引用的镜像以本地 tag 缓存为准 (本进程构建成功的镜像会加入缓存)，
+        未命中时不再逐个查询 Docker 服务；
+        只有按 ID/digest 引用的镜像 (不会出现在 RepoTags 中) 才用底层 API inspect_image 确认
+        """
+        if self._tag_cache is None:
+            self._refresh_tag_cache()
+        tag = self._normalize_tag(image_name)
+        if tag in self._tag_cache:
             return True
-        except docker.errors.ImageNotFound:
+        if "@" not in image_name and not image_name.startswith("sha256:"):
             return False
+        try:
+            self.client.api.inspect_image(image_name)
+        except docker.errors.NotFound:
+            return False
+        self._tag_cache.add(tag)
+        return True
+
+    def build_image(self, json_file_path: Path, image_name: str, force_rebuild: bool = False,
+                    cache_from: list[str] | None = None):
+        """
+        构建 Docker 镜像 (日志先写入缓冲区；终端空闲时定期输出，已有其他构建在实时输出时，构建结束后整段输出)
+        cache_from: 可作为层缓存来源的候选镜像 (通常是同一仓库其他 PR 的镜像)，
+                    构建开始时只使用其中本地已存在的镜像
+        """
+        out = io.StringIO()
+        # 只有一个构建在进行时 (包括单镜像运行) 实时输出；多个构建同时进行时其余构建缓冲，避免日志交错
+        live_output = self._acquire_live_output()
+        # 日志块以镜像名称开头，扫描阶段的表头与构建日志不相邻时也能分辨归属
+        print(f"\n>>> 镜像: {image_name}", file=out)
+        try:
+            return self._build_image(json_file_path, image_name, force_rebuild, cache_from, live_output, out)
+        except Exception as e:
+            # 在工作线程内兜底 (如查询镜像时 Docker 服务出错)，计为构建失败，
+            # 保证 future.result() 不抛异常，EXIT_ON_FAILURE 与统计照常生效
+            summary = self._record_error(e, f"构建镜像 {image_name}")
+            print(f"   ❌ 构建时发生未知错误: {summary} (完整堆栈见 {ERROR_LOG})", file=out)
+            return False
+        finally:
+            if live_output:
+                self._log(out.getvalue())
+                self._release_live_output()
+            else:
+                self._log_when_idle(out.getvalue())
 
-    def build_image(self, json_file_path: Path, image_name: str, force_rebuild: bool = False):
-        """构建 Docker 镜像 (实时输出日志)"""
-        
+    def _build_image(self, json_file_path: Path, image_name: str, force_rebuild: bool,
+                     cache_from: list[str] | None, live_output: bool, out: io.StringIO):
         # 检查镜像是否已存在
         if not force_rebuild and self.check_image_exists(image_name):
-            print(f"   ✅ 镜像已存在，跳过构建")
+            print(f"   ✅ 镜像已存在，跳过构建", file=out)
             return True
 
         if force_rebuild and self.check_image_exists(image_name):
-            print(f"   🔄 强制重新构建镜像...")
+            print(f"   🔄 强制重新构建镜像...", file=out)
         else:
-            print(f"   🔨 开始构建镜像...")
+            print(f"   🔨 开始构建镜像...", file=out)
 
         source_dir = json_file_path.parent.absolute()
 
         # 检查必要文件是否存在
         dockerfile_path = source_dir / "Dockerfile"
         if not dockerfile_path.exists():
-            print(f"   ❌ 错误: Dockerfile 不存在于 {source_dir}")
+            print(f"   ❌ 错误: Dockerfile 不存在于 {source_dir}", file=out)
             return False
 
         try:
-            print(f"   -> 构建上下文: {source_dir}")
-            print(f"   -> Dockerfile: {dockerfile_path}")
-            print(f"   -> 镜像名称: {image_name}")
-            print("   --- 构建日志 START ---")
+            print(f"   -> 构建上下文: {source_dir}", file=out)
+            print(f"   -> Dockerfile: {dockerfile_path}", file=out)
+            print(f"   -> 镜像名称: {image_name}", file=out)
+            # 只查本地 tag 缓存，不为尚未构建的同仓库镜像逐个请求 Docker 服务。
+            # 强制重建 (nocache) 时 cache_from 没有意义；关闭 CACHE_FROM_SIBLINGS 时保留本地缓存的原有行为
+            cache_sources = [
+                img for img in (cache_from or [])
+                if img != image_name and self._normalize_tag(img) in self._tag_cache
+            ] if CACHE_FROM_SIBLINGS and not force_rebuild else []
+            if cache_sources:
+                print(f"   -> 缓存来源: {', '.join(cache_sources)}", file=out)
+            print("   --- 构建日志 START ---", file=out)
 
             # 使用底层 API (client.api.build) 来获取流式响应
             response = self.client.api.build(
@@ -94,50 +317,107 @@ class DockerImageBuilder:
                 rm=True,
                 forcerm=True,
                 nocache=force_rebuild,
+                cache_from=cache_sources or None,  # 复用同仓库已有镜像的层
                 decode=True  # 关键：将流解码为 JSON 对象
             )
 
             build_success = True
-            
-            # 迭代生成器，实时打印
-            for chunk in response:
+            last_flush = time.monotonic()
+            # 实时输出时由后台线程读取构建输出，长时间无输出的步骤也能按时写出缓冲区
+            chunks = _iter_with_idle_ticks(response, LOG_FLUSH_INTERVAL) if live_output else response
+
+            # 迭代生成器，写入本次构建的日志缓冲区
+            for chunk in chunks:
+                if live_output:
+                    now = time.monotonic()
+                    if out.tell() and (chunk is None or out.tell() >= LOG_FLUSH_BYTES
+                                       or now - last_flush >= LOG_FLUSH_INTERVAL):
+                        self._flush_buffer(out)
+                        last_flush = now
+                if chunk is None:
+                    continue
                 if 'stream' in chunk:
-                    # stream 中通常自带换行符，所以 end=''，flush=True 确保立即显示
-                    print(chunk['stream'], end='', flush=True)
+                    # stream 中通常自带换行符，直接写入
+                    out.write(chunk['stream'])
                 elif 'error' in chunk:
-                    print(f"\n❌ 构建错误: {chunk['error']}")
+                    print(f"\n❌ 构建错误: {chunk['error']}", file=out)
                     build_success = False
                 elif 'errorDetail' in chunk:
-                    print(f"\n❌ 错误详情: {chunk['errorDetail']}")
+                    print(f"\n❌ 错误详情: {chunk['errorDetail']}", file=out)
                     build_success = False
                 elif 'status' in chunk:
                     # 打印如 Pulling fs layer 等状态信息，可选
-                    # print(f"\n>> {chunk['status']}", end='', flush=True)
+                    # print(f"\n>> {chunk['status']}", end='', file=out)
                     pass
 
-            print("\n   --- 构建日志 END ---")
+            print("\n   --- 构建日志 END ---", file=out)
 
             if build_success:
-                print(f"   ✅ 镜像构建成功: {image_name}")
+                if self._tag_cache is not None:
+                    self._tag_cache.add(self._normalize_tag(image_name))
+                print(f"   ✅ 镜像构建成功: {image_name}", file=out)
                 return True
             else:
                 error_msg = f"❌❌❌ Docker 构建失败: {image_name} ❌❌❌"
-                print(f"\n{error_msg}")
+                print(f"\n{error_msg}", file=out)
                 # 如果你想在这里直接抛出异常给上层处理：
                 # raise RuntimeError(error_msg) 
                 return False
 
         except docker.errors.APIError as e:
-            print(f"   ❌ Docker API 错误: {e}")
+            print(f"   ❌ Docker API 错误: {e}", file=out)
             return False
         except Exception as e:
-            print(f"   ❌ 构建时发生未知错误: {e}")
-            import traceback
-            traceback.print_exc()
+            summary = self._record_error(e, f"构建镜像 {image_name}")
+            print(f"   ❌ 构建时发生未知错误: {summary} (完整堆栈见 {ERROR_LOG})", file=out)
             return False
 
+    @staticmethod
+    def _load_scan_cache(tasks_dir: Path) -> dict:
+        """读取上次运行留下的扫描缓存，读取失败时视为空缓存"""
+        try:
+            return _json_loads((tasks_dir / SCAN_CACHE_FILE).read_bytes())
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _save_scan_cache(tasks_dir: Path, scan_cache: dict):
+        """原子地写回扫描缓存 (先写临时文件再替换)"""
+        cache_path = tasks_dir / SCAN_CACHE_FILE
+        tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+        try:
+            tmp_path.write_text(json.dumps(scan_cache, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"   -> ⚠️ 警告: 无法写入扫描缓存 {cache_path}: {e}")
+
+    @staticmethod
+    def _read_instance_id(entry: os.DirEntry, old_cache: dict, new_cache: dict) -> str | None:
+        """
+        读取任务文件中的 instance_id。
+        文件的 mtime 和大小未变化时直接使用缓存；
+        文件内容中不含 "instance_id" 时不做完整的 JSON 解析。
+        """
+        key = entry.path
+        st = entry.stat()
+        cached = old_cache.get(key)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            new_cache[key] = cached
+            return cached[2]
+
+        with open(key, "rb") as f:
+            raw = f.read()
+        instance_id = None
+        if b'"instance_id"' in raw:
+            data = _json_loads(raw)
+            if isinstance(data, dict):
+                instance_id = data.get("instance_id")
+
+        new_cache[key] = [st.st_mtime_ns, st.st_size, instance_id]
+        return instance_id
+
     def process_tasks(self, tasks_dir: Path, force_rebuild: bool = False, skip_existing: bool = True):
-        """处理任务目录中的所有任务"""
+        """处理任务目录中的所有任务 (边扫描边提交构建，扫描与构建并行进行)"""
         if not tasks_dir.is_dir():
             print(f"❌ 错误: 任务目录 '{tasks_dir}' 不存在。")
             return
@@ -145,88 +425,115 @@ class DockerImageBuilder:
         print(f"\n🔍 开始扫描目录: {tasks_dir}")
         print(f"   强制重建: {'是' if force_rebuild else '否'}")
         print(f"   跳过已存在: {'是' if skip_existing else '否'}")
+        print(f"   并行构建数: {self.max_workers}")
         
         processed_images = set()
         success_count = 0
         skip_count = 0
         fail_count = 0
 
-        for json_file in tasks_dir.rglob("*.json"):
-            # 跳过结果文件
-            if json_file.name == "result.json":
-                continue
-            
-            try:
-                with open(json_file, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                
-                # 检查是否包含 instance_id
-                instance_id = data.get("instance_id")
-                if not instance_id:
-                    continue
-
-                parsed_info = self.parse_instance_id(instance_id)
-                if not parsed_info:
-                    continue
-
-                # 将 parsed_info 中的 repo_owner 和 repo_name 转换为小写
-                parsed_info_lower = {
-                    "repo_owner": parsed_info["repo_owner"].lower(),
-                    "repo_name": parsed_info["repo_name"].lower(),
-                    "pr_id": parsed_info["pr_id"]
-                }
-                image_name = IMAGE_NAME_TEMPLATE.format(**parsed_info_lower)
-
-                # 避免重复处理同一个镜像
-                if image_name in processed_images:
-                    continue
-
-                processed_images.add(image_name)
-                print(f"\n{'='*60}")
-                print(f"镜像: {image_name}")
-                print(f"任务: {instance_id}")
-                print(f"{'='*60}")
+        repo_images: dict[tuple[str, str], list[str]] = {}  # (owner, repo) -> 该仓库的所有镜像
+        old_scan_cache = self._load_scan_cache(tasks_dir)
+        scan_cache = {}
+        futures = {}
+        stop_event = threading.Event()  # EXIT_ON_FAILURE 触发后停止扫描和提交
 
-                # 检查镜像是否已存在
-                if skip_existing and not force_rebuild and self.check_image_exists(image_name):
-                    print(f"   ✅ 镜像已存在，跳过构建")
-                    skip_count += 1
-                    continue
+        # 扫描缓存写入任务目录 (可能就是构建上下文)，须等所有构建结束后再写，
+        # 避免构建打包上下文时临时文件被替换；EXIT_ON_FAILURE 退出时同样保存
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                def on_build_done(future):
+                    if EXIT_ON_FAILURE and not future.cancelled() and not future.result():
+                        stop_event.set()
+                        # 取消尚未开始的构建；已在进行中的构建会等待其结束
+                        executor.shutdown(wait=False, cancel_futures=True)
+
+                # 1. 扫描任务文件，每发现一个需要构建的镜像就立即提交到线程池
+                for entry in _iter_task_json_files(str(tasks_dir)):
+                    if stop_event.is_set():
+                        break
+                    try:
+                        # 检查是否包含 instance_id
+                        instance_id = self._read_instance_id(entry, old_scan_cache, scan_cache)
+                        if not instance_id:
+                            continue
+
+                        json_file = Path(entry.path)
+
+                        parsed_info = self.parse_instance_id(instance_id)
+                        if not parsed_info:
+                            continue
+
+                        image_name = _image_name_for(**parsed_info)
+
+                        # 避免重复处理同一个镜像
+                        if image_name in processed_images:
+                            continue
+
+                        processed_images.add(image_name)
+                        siblings = repo_images.setdefault((parsed_info["repo_owner"], parsed_info["repo_name"]), [])
+                        siblings.append(image_name)
+                        header = f"\n{SEPARATOR}\n镜像: {image_name}\n任务: {instance_id}\n{SEPARATOR}\n"
+
+                        # 检查镜像是否已存在
+                        if skip_existing and not force_rebuild and self.check_image_exists(image_name):
+                            self._log_when_idle(f"{header}   ✅ 镜像已存在，跳过构建\n")
+                            skip_count += 1
+                            continue
+
+                        try:
+                            future = executor.submit(self.build_image, json_file, image_name, force_rebuild, siblings)
+                        except RuntimeError:
+                            # EXIT_ON_FAILURE 已触发，线程池已关闭
+                            break
+                        futures[future] = (json_file, image_name)
+                        future.add_done_callback(on_build_done)
+                        self._log_when_idle(f"{header}   ⏳ 已加入构建队列\n")
+
+                    except json.JSONDecodeError:
+                        self._log_when_idle(f"   -> ⚠️ 跳过无效 JSON 文件: {entry.name}\n")
+                        continue
+                    except Exception as e:
+                        summary = self._record_error(e, f"处理文件 {entry.path}")
+                        self._log_when_idle(f"🚨 处理文件 '{entry.path}' 时发生错误: {summary} (完整堆栈见 {ERROR_LOG})\n")
+                        fail_count += 1
+
+                # 2. 按完成顺序汇总构建结果
+                for future in as_completed(futures):
+                    if future.cancelled():
+                        continue
+                    json_file, image_name = futures[future]
+                    if future.result():
+                        success_count += 1
+                        continue
 
-                # 构建镜像
-                if self.build_image(json_file, image_name, force_rebuild):
-                    success_count += 1
-                else:
                     fail_count += 1
                     if EXIT_ON_FAILURE:
-                        print(f"\n🚨 检测到构建失败，且配置为立即终止 (EXIT_ON_FAILURE=True)。")
-                        print(f"   失败镜像: {image_name}")
-                        print(f"   相关文件: {json_file}")
+                        self._log_when_idle(
+                            f"\n🚨 检测到构建失败，且配置为立即终止 (EXIT_ON_FAILURE=True)。\n"
+                            f"   失败镜像: {image_name}\n"
+                            f"   相关文件: {json_file}\n"
+                        )
                         sys.exit(1) # 退出程序
-
-            except json.JSONDecodeError:
-                print(f"   -> ⚠️ 跳过无效 JSON 文件: {json_file.name}")
-                continue
-            except Exception as e:
-                print(f"🚨 处理文件 '{json_file}' 时发生错误: {e}")
-                import traceback
-                traceback.print_exc()
-                fail_count += 1
+        finally:
+            self._save_scan_cache(tasks_dir, scan_cache)
 
         # 打印统计信息
-        print(f"\n{'='*60}")
-        print(f"📊 构建统计:")
-        print(f"   总计镜像: {len(processed_images)}")
-        print(f"   ✅ 成功构建: {success_count}")
-        print(f"   ⏭️  跳过: {skip_count}")
-        print(f"   ❌ 失败: {fail_count}")
-        print(f"{'='*60}")
+        print(
+            f"\n{SEPARATOR}\n"
+            f"📊 构建统计:\n"
+            f"   总计镜像: {len(processed_images)}\n"
+            f"   ✅ 成功构建: {success_count}\n"
+            f"   ⏭️  跳过: {skip_count}\n"
+            f"   ❌ 失败: {fail_count}\n"
+            f"{SEPARATOR}"
+        )
 
 
 def build():
     """主函数"""
     print("🐳 Docker 镜像构建工具 (实时输出版)")
-    print("="*60)
+    print(SEPARATOR)
     
     builder = DockerImageBuilder()
     builder.process_tasks(TASKS_DIR, FORCE_REBUILD, SKIP_EXISTING)
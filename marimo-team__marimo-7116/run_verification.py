@@ -3,9 +3,18 @@ import subprocess
 import sys
 import os
 import json
+import re
+import hashlib
+import shlex
+import tempfile
 from pathlib import Path
 import xml.etree.ElementTree as ET
-from typing import Union, List
+from typing import Union, List, Optional
+
+try:
+    import orjson  # 可选依赖: 更快的 JSON 序列化
+except ImportError:
+    orjson = None
 
 # --- 配置 ---
 # 请在这里设置你的代码仓库的绝对路径
@@ -19,6 +28,25 @@ INSTANCE_ID = 'marimo-team__marimo-7116'
 # --- 路径配置 (自动计算) ---
 SCRIPT_DIR = Path(__file__).resolve().parent
 REPO_DIR = Path(REPO_PATH)
+# 在 hatch 测试环境中执行命令的前缀
+TEST_ENV_COMMAND = ["hatch", "run", "+py=3.12"]
+# 附加的 pytest 参数: 不写入 .pytest_cache，精简输出
+PYTEST_EXTRA_ARGS = ["-p", "no:cacheprovider", "-q", "--no-header"]
+# 补丁前测试结果的缓存文件，键由 BASE_COMMIT、test.patch 内容和测试文件列表共同决定
+PRE_PATCH_CACHE_PATH = SCRIPT_DIR / ".pre_patch_cache.json"
+# 验证镜像 ID 由 verification.py 通过该环境变量传入，纳入缓存键: 镜像重建后旧缓存自动失效
+IMAGE_ID_ENV = "VERIFICATION_IMAGE_ID"
+# 同时运行多个验证容器时，verification.py 通过该环境变量传入本容器可用的 xdist worker 数 (未设置时为 auto)
+XDIST_WORKERS_ENV = "VERIFICATION_XDIST_WORKERS"
+# 该环境变量非空时不读取补丁前缓存 (verification.py --force)，重新运行并覆盖缓存
+NO_CACHE_ENV = "VERIFICATION_NO_CACHE"
+# 描述测试环境的文件，内容变化同样使缓存失效 (不存在的文件按空内容处理)
+ENV_DEFINITION_FILES = ("Dockerfile", "setup_env.sh", "setup_repo.sh")
+
+# 将模块路径中的 '.' 转换为 '/' (JUnit classname -> 文件路径)
+_DOT_TO_SLASH = str.maketrans('.', '/')
+# 补丁文件头行: '--- a/path/to/file.py' 或 '+++ b/path/to/file.py'
+_PATCH_PY_FILE_RE = re.compile(rb"^(?:--- a|\+\+\+ b)/(\S+\.py)[ \t\r]*$", re.M)
 
 class Colors:
     """用于在终端中彩色打印的辅助类。"""
@@ -46,23 +74,27 @@ results = {
 
 # --- 辅助函数 ---
 
+# 标题分隔线 (预先格式化，避免每次调用时重复拼接)
+_HEADER_SEP = f"{Colors.BLUE}{'='*60}{Colors.ENDC}\n"
+
 def print_header(message):
-    """打印格式化的标题。"""
-    print(f"\n{Colors.BLUE}{'='*60}{Colors.ENDC}")
-    print(f"{Colors.BLUE}=== {message}{Colors.ENDC}")
-    print(f"{Colors.BLUE}{'='*60}{Colors.ENDC}")
+    """打印格式化的标题 (整块一次写出并刷新)。"""
+    sys.stdout.write(f"\n{_HEADER_SEP}{Colors.BLUE}=== {message}{Colors.ENDC}\n{_HEADER_SEP}")
+    sys.stdout.flush()
 
-def run_command(command, cwd, check=True):
+def run_command(command, cwd, check=True, capture_stdout=True):
     """运行一个子进程命令并返回结果。
     
     适配 Python 3.6: 使用 stdout=PIPE, stderr=PIPE 替代 capture_output=True,
     使用 universal_newlines=True 替代 text=True。
+    capture_stdout=False 时 stdout 直接丢弃 (DEVNULL)，返回的 stdout 为 None；
+    用于只关心成功与否的命令。
     """
     try:
         process = subprocess.run(
             command, 
             check=check, 
-            stdout=subprocess.PIPE, # 替代 capture_output=True
+            stdout=subprocess.PIPE if capture_stdout else subprocess.DEVNULL, # 替代 capture_output=True
             stderr=subprocess.PIPE, # 替代 capture_output=True
             universal_newlines=True, # 替代 text=True
             cwd=str(cwd)
@@ -76,14 +108,23 @@ def run_command(command, cwd, check=True):
 def reset_repo(commit_hash):
     """重置仓库到指定的 commit，并强制清理所有未跟踪的文件。"""
     print_header(f"RESETTING REPO TO COMMIT: {commit_hash[:7]}")
-    success, _, stderr = run_command(["git", "reset", "--hard", commit_hash], cwd=REPO_DIR)
-    if not success:
-        print(f"{Colors.RED}[ERROR] 'git reset --hard' failed.{Colors.ENDC}\n{stderr}")
-        return False
-    success_clean, _, stderr_clean = run_command(["git", "clean", "-df"], cwd=REPO_DIR)
-    if not success_clean:
-        print(f"{Colors.RED}[ERROR] 'git clean -df' failed.{Colors.ENDC}\n{stderr}")
-        return False
+    if os.name != "nt":
+        # 通过一次 sh 调用依次执行两个 git 命令，减少从 Python 进程派生子进程的次数
+        script = f"git reset --hard {shlex.quote(commit_hash)} && exec git clean -df"
+        success, _, stderr = run_command(["sh", "-c", script], cwd=REPO_DIR, capture_stdout=False)
+        if not success:
+            print(f"{Colors.RED}[ERROR] 'git reset --hard && git clean -df' failed.{Colors.ENDC}\n{stderr}")
+            return False
+    else:
+        # Windows 下没有 sh，分别执行
+        success, _, stderr = run_command(["git", "reset", "--hard", commit_hash], cwd=REPO_DIR, capture_stdout=False)
+        if not success:
+            print(f"{Colors.RED}[ERROR] 'git reset --hard' failed.{Colors.ENDC}\n{stderr}")
+            return False
+        success_clean, _, stderr_clean = run_command(["git", "clean", "-df"], cwd=REPO_DIR, capture_stdout=False)
+        if not success_clean:
+            print(f"{Colors.RED}[ERROR] 'git clean -df' failed.{Colors.ENDC}\n{stderr_clean}")
+            return False
     print(f"{Colors.GREEN}[SUCCESS] Repo has been forcefully reset and cleaned.{Colors.ENDC}")
     return True
 
@@ -94,7 +135,7 @@ def apply_patch(patch_path):
         print(f"{Colors.YELLOW}[INFO] Patch file {patch_path.name} not found, skipping.{Colors.ENDC}")
         return True
     print(f"{Colors.YELLOW}   -> Applying patch: {patch_path.name}{Colors.ENDC}")
-    success, _, stderr = run_command(["git", "apply", str(patch_path)], cwd=REPO_DIR)
+    success, _, stderr = run_command(["git", "apply", str(patch_path)], cwd=REPO_DIR, capture_stdout=False)
     if not success:
         # 替换 ❌
         print(f"{Colors.RED}[ERROR] Applying patch {patch_path.name} failed.{Colors.ENDC}\n{stderr}")
@@ -103,38 +144,33 @@ def apply_patch(patch_path):
     print(f"{Colors.GREEN}[SUCCESS] Applied patch {patch_path.name} successfully.{Colors.ENDC}")
     return True
     
-def get_modified_test_files_from_patch(patch_path: Path) -> List[str]:
+def read_patch(patch_path: Path) -> Optional[bytes]:
+    """一次性读取补丁文件内容，文件不存在或读取失败时返回 None。"""
+    if not patch_path.is_file():
+        return None
+    try:
+        return patch_path.read_bytes()
+    except OSError as e:
+        print(f"{Colors.RED}[ERROR] Failed to read patch file {patch_path}: {e}{Colors.ENDC}")
+        return None
+
+def _parse_patch_files(patch_bytes: bytes) -> List[str]:
+    """从补丁内容中解析出所有被修改的 .py 文件路径 (去重并排序)。"""
+    return sorted(set(m.decode('utf-8', errors='ignore') for m in _PATCH_PY_FILE_RE.findall(patch_bytes)))
+
+def get_modified_test_files_from_patch(patch_path: Path, patch_bytes: Optional[bytes]) -> List[str]:
     """
-    从指定的补丁文件中解析出所有被修改的 .py 文件路径。
-    如果文件不存在、读取失败或没有找到 .py 文件，则返回原始的默认测试文件列表。
+    从已读取的补丁内容中解析出所有被修改的 .py 文件路径。
+    如果补丁内容为空 (文件不存在或读取失败) 或没有找到 .py 文件，则返回原始的默认测试文件列表。
     """
     # 原始的默认测试文件列表
     DEFAULT_TEST_FILES = ["tests/reference.py", "tests/test_kerns.py", "tests/test_likelihoods.py"]
 
-    if not patch_path.is_file():
-        print(f"{Colors.YELLOW}[INFO] Patch file {patch_path.name} not found. Running default tests.{Colors.ENDC}")
+    if patch_bytes is None:
+        print(f"{Colors.YELLOW}[INFO] Patch file {patch_path.name} not available. Running default tests.{Colors.ENDC}")
         return DEFAULT_TEST_FILES
 
-    modified_files = set()
-    try:
-        with open(patch_path, 'r', encoding='utf-8', errors='ignore') as f:
-            for line in f:
-                # 补丁文件头行格式通常是 '--- a/path/to/file' 或 '+++ b/path/to/file'
-                if line.startswith('--- a/') or line.startswith('+++ b/'):
-                    # 提取路径并去除 'a/' 或 'b/' 前缀
-                    path = line.split(' ', 2)[1].strip()
-                    if path.startswith('a/') or path.startswith('b/'):
-                        path = path[2:]
-                    
-                    # 仅添加 Python 文件
-                    if path.endswith('.py'):
-                        modified_files.add(path)
-                        
-    except Exception as e:
-        print(f"{Colors.RED}[ERROR] Failed to read or parse patch file {patch_path}: {e}. Running default tests.{Colors.ENDC}")
-        return DEFAULT_TEST_FILES
-
-    file_list = sorted(list(modified_files))
+    file_list = _parse_patch_files(patch_bytes)
     
     if not file_list:
          print(f"{Colors.YELLOW}[INFO] No Python files found in {patch_path}. Running default tests.{Colors.ENDC}")
@@ -153,32 +189,24 @@ def parse_junit_xml_report(report_path: Path) -> Union[dict, None]:
         
     test_results = {}
     try:
-        tree = ET.parse(report_path)
-        root = tree.getroot()
-        for testcase in root.iter("testcase"):
+        # 流式解析: 每处理完一个 testcase 就清空它，内存占用不随用例数量增长
+        for _, testcase in ET.iterparse(str(report_path), events=("end",)):
+            if testcase.tag != "testcase":
+                continue
             class_name = testcase.get("classname", "")
             test_name = testcase.get("name", "")
             
-            nodeid = ""
             if class_name:
-
-                if any(c.isupper() for c in class_name):
-
-                    parts = class_name.split('.')
-                    module_path_parts = parts[:-1]
-                    class_name_only = parts[-1]   
-                    
+                # 含有大写字母，说明最后一段是类名
+                if class_name != class_name.lower():
+                    module_path, sep, class_name_only = class_name.rpartition('.')
                     # 将模块路径转换为文件路径
-                    if module_path_parts:
-                        file_path = "/".join(module_path_parts) + ".py"
+                    if sep:
+                        nodeid = f"{module_path.translate(_DOT_TO_SLASH)}.py::{class_name_only}::{test_name}"
                     else:
-                        file_path = f"{class_name_only}.py"
-                        
-                    nodeid = f"{file_path}::{class_name_only}::{test_name}"
+                        nodeid = f"{class_name_only}.py::{class_name_only}::{test_name}"
                 else:
-                    parts = class_name.split('.')
-                    file_path = "/".join(parts) + ".py"
-                    nodeid = f"{file_path}::{test_name}"
+                    nodeid = f"{class_name.translate(_DOT_TO_SLASH)}.py::{test_name}"
             else:
                 nodeid = test_name
 
@@ -192,6 +220,8 @@ def parse_junit_xml_report(report_path: Path) -> Union[dict, None]:
                 test_results[nodeid] = "error"
             elif skipped_node is None:
                 test_results[nodeid] = "passed"
+
+            testcase.clear()
                 
     except ET.ParseError as e:
         print(f"{Colors.RED}   -> FAILED: Could not parse the JUnit XML report: {e}{Colors.ENDC}")
@@ -206,18 +236,56 @@ def parse_junit_xml_report(report_path: Path) -> Union[dict, None]:
 
     return test_results
 
+def filter_existing_repo_files(file_paths: List[str]) -> List[str]:
+    """
+    筛选出仓库中实际存在的文件 (保持原有顺序)。
+    按所在目录分组，每个目录只 scandir 一次，代替对每个文件单独 stat。
+    """
+    dir_listings = {}
+    existing_files = []
+    for file_path_str in file_paths:
+        parent, _, name = file_path_str.rpartition("/")
+        if parent not in dir_listings:
+            try:
+                with os.scandir(str(REPO_DIR / parent)) as it:
+                    dir_listings[parent] = {entry.name for entry in it if entry.is_file()}
+            except OSError:
+                dir_listings[parent] = set()
+        if name in dir_listings[parent]:
+            existing_files.append(file_path_str)
+    return existing_files
+
+_xdist_available = None
+
+def is_xdist_available() -> bool:
+    """检查测试环境中是否安装了 pytest-xdist (结果缓存，只检查一次)。"""
+    global _xdist_available
+    if _xdist_available is None:
+        _xdist_available, _, _ = run_command(TEST_ENV_COMMAND + ["test:python", "-c", "import xdist"], cwd=REPO_DIR, capture_stdout=False)
+        if not _xdist_available:
+            print(f"{Colors.YELLOW}[INFO] pytest-xdist not available in test env, running tests serially.{Colors.ENDC}")
+    return _xdist_available
+
+def get_parallel_args() -> List[str]:
+    """返回 pytest-xdist 并行参数；worker 数为 1 或未安装 xdist 时串行执行。"""
+    workers = os.environ.get(XDIST_WORKERS_ENV, "auto")
+    if workers != "auto" and not workers.isdigit():
+        workers = "auto"
+    if workers in ("0", "1") or not is_xdist_available():
+        return []
+    return ["-n", workers]
+
 def run_all_tests_and_get_results(test_files: List[str]) -> Union[dict, None]:
     """使用 pytest 运行指定的测试文件列表，并从 JUnit XML 报告中解析结果。"""
-    report_file=SCRIPT_DIR/f"report_{os.getpid()}.xml"
+    # 报告写入临时目录: SCRIPT_DIR 可能是挂载进容器的宿主机目录，不在其中留下中间文件
+    report_file=Path(tempfile.gettempdir())/f"report_{os.getpid()}.xml"
 
-    existing_test_files = []
-    for file_path_str in test_files:
-        repo_file_path = REPO_DIR / file_path_str
-        if repo_file_path.is_file():
-            existing_test_files.append(file_path_str)
+    existing_test_files = filter_existing_repo_files(test_files)
 
     # 将动态获取的测试文件列表添加到 command 中
-    command=["hatch", "run", "+py=3.12", "test:test"] + existing_test_files + [f"--junitxml={str(report_file)}"]
+    # 安装了 pytest-xdist 时并行执行; junit 报告会汇总所有 worker 的结果
+    parallel_args = get_parallel_args()
+    command=TEST_ENV_COMMAND + ["test:test"] + parallel_args + PYTEST_EXTRA_ARGS + existing_test_files + [f"--junitxml={str(report_file)}"]
 
     # 打印执行的命令
     print(f"{Colors.BLUE}   -> Executing: pytest {' '.join(test_files)}{Colors.ENDC}")
@@ -229,12 +297,49 @@ def run_all_tests_and_get_results(test_files: List[str]) -> Union[dict, None]:
         print(f"{Colors.GREEN} -> COMPLETED: Parsed {len(results)} test results.{Colors.ENDC}")
     return results
 
+def get_pre_patch_cache_key(test_patch_bytes: Optional[bytes], test_files: List[str]) -> str:
+    """补丁前的测试结果取决于 (BASE_COMMIT, test.patch, 测试文件列表) 和测试环境 (镜像 ID、环境定义文件)，据此计算缓存键。"""
+    h = hashlib.sha256(BASE_COMMIT.encode())
+    h.update(test_patch_bytes or b"")
+    h.update(repr(test_files).encode())
+    h.update(b"\0image:" + os.environ.get(IMAGE_ID_ENV, "").encode())
+    for name in ENV_DEFINITION_FILES:
+        h.update(b"\0" + name.encode() + b":")
+        try:
+            h.update((SCRIPT_DIR / name).read_bytes())
+        except OSError:
+            pass
+    return h.hexdigest()
+
+def load_pre_patch_cache(key: str) -> Union[dict, None]:
+    """读取缓存的补丁前测试结果，未命中、读取失败或设置了 NO_CACHE_ENV 时返回 None。"""
+    if os.environ.get(NO_CACHE_ENV):
+        return None
+    try:
+        with open(PRE_PATCH_CACHE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f).get(key)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def save_pre_patch_cache(key: str, test_results: dict):
+    """原子地写入补丁前测试结果缓存 (先写临时文件再替换)。"""
+    tmp_path = PRE_PATCH_CACHE_PATH.with_name(PRE_PATCH_CACHE_PATH.name + ".tmp")
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({key: test_results}, f)
+        os.replace(str(tmp_path), str(PRE_PATCH_CACHE_PATH))
+    except OSError as e:
+        print(f"{Colors.YELLOW}   -> WARNING: Could not write pre-patch cache {PRE_PATCH_CACHE_PATH}: {e}{Colors.ENDC}")
+
 def write_results_and_exit(success=True):
     """将最终结果写入json文件并退出程序。"""
     output_path = SCRIPT_DIR / "results.json"
     print_header("FINAL STEP: WRITING results.json")
     try:
-        with open(output_path, "w") as f: json.dump(results, f, indent=4)
+        if orjson is not None:
+            with open(output_path, "wb") as f: f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+        else:
+            with open(output_path, "w") as f: json.dump(results, f, indent=4)
         # 替换 ✅
         print(f"{Colors.GREEN}[SUCCESS] Successfully wrote results to {output_path}{Colors.ENDC}")
     except Exception as e:
@@ -247,16 +352,26 @@ def main():
     
     # 1. 确定要运行的测试文件列表
     test_patch_path = SCRIPT_DIR / "test.patch"
-    test_files_to_run = get_modified_test_files_from_patch(test_patch_path)
-
-    # --- 补丁前运行 ---
-    if not reset_repo(BASE_COMMIT): write_results_and_exit(False)
-    if not apply_patch(test_patch_path): write_results_and_exit(False)
-    
-    print_header("STEP 1: PRE-PATCH - Running tests with only test patch")
-    # 传递动态生成的测试文件列表
-    pre_patch_results = run_all_tests_and_get_results(test_files_to_run)
-    if pre_patch_results is None: write_results_and_exit(False)
+    test_patch_bytes = read_patch(test_patch_path)
+    test_files_to_run = get_modified_test_files_from_patch(test_patch_path, test_patch_bytes)
+
+    # --- 补丁前运行 (命中缓存时跳过) ---
+    pre_patch_cache_key = get_pre_patch_cache_key(test_patch_bytes, test_files_to_run)
+    pre_patch_results = load_pre_patch_cache(pre_patch_cache_key)
+    if pre_patch_results is not None:
+        print_header("STEP 1: PRE-PATCH - Using cached results")
+        print(f"{Colors.GREEN} -> CACHED: Loaded {len(pre_patch_results)} test results from {PRE_PATCH_CACHE_PATH.name}.{Colors.ENDC}")
+    else:
+        if not reset_repo(BASE_COMMIT): write_results_and_exit(False)
+        if not apply_patch(test_patch_path): write_results_and_exit(False)
+        
+        print_header("STEP 1: PRE-PATCH - Running tests with only test patch")
+        # 传递动态生成的测试文件列表
+        pre_patch_results = run_all_tests_and_get_results(test_files_to_run)
+        if pre_patch_results is None: write_results_and_exit(False)
+        # 没有任何测试通过时很可能是环境问题，不缓存，下次重新运行
+        if "passed" in pre_patch_results.values():
+            save_pre_patch_cache(pre_patch_cache_key, pre_patch_results)
 
     # --- 补丁后运行 ---
     if not reset_repo(BASE_COMMIT): write_results_and_exit(False)
@@ -271,20 +386,20 @@ def main():
 
     # --- 结果分类 ---
     print_header("STEP 3: CATEGORIZING RESULTS")
-    all_tests_run = set(pre_patch_results.keys()) | set(post_patch_results.keys())
-    
-    for test in sorted(list(all_tests_run)):
-        pre_status = pre_patch_results.get(test, "passed")
-        post_status = post_patch_results.get(test, "failed")
-
-        if pre_status == "failed" and post_status == "passed":
-            results[INSTANCE_ID]["tests_status"]["FAIL_TO_PASS"]["success"].append(test)
-        elif pre_status == "passed" and post_status == "passed":
-            results[INSTANCE_ID]["tests_status"]["PASS_TO_PASS"]["success"].append(test)
-        elif pre_status == "failed" and post_status == "failed":
-            results[INSTANCE_ID]["tests_status"]["FAIL_TO_FAIL"]["failure"].append(test)
-        elif pre_status == "passed" and post_status == "failed":
-            results[INSTANCE_ID]["tests_status"]["PASS_TO_FAIL"]["failure"].append(test)
+    all_tests_run = pre_patch_results.keys() | post_patch_results.keys()
+
+    # 补丁前缺失的测试视为 passed，补丁后缺失的测试视为 failed；
+    # 状态为 error 的测试不属于任何分类
+    pre_passed = (all_tests_run - pre_patch_results.keys()) | {t for t, s in pre_patch_results.items() if s == "passed"}
+    pre_failed = {t for t, s in pre_patch_results.items() if s == "failed"}
+    post_passed = {t for t, s in post_patch_results.items() if s == "passed"}
+    post_failed = (all_tests_run - post_patch_results.keys()) | {t for t, s in post_patch_results.items() if s == "failed"}
+
+    tests_status = results[INSTANCE_ID]["tests_status"]
+    tests_status["FAIL_TO_PASS"]["success"].extend(sorted(pre_failed & post_passed))
+    tests_status["PASS_TO_PASS"]["success"].extend(sorted(pre_passed & post_passed))
+    tests_status["FAIL_TO_FAIL"]["failure"].extend(sorted(pre_failed & post_failed))
+    tests_status["PASS_TO_FAIL"]["failure"].extend(sorted(pre_passed & post_failed))
     
     for category, result in results[INSTANCE_ID]["tests_status"].items():
         if result["success"]: print(f"{Colors.GREEN}  [{category}]: {len(result['success'])} tests{Colors.ENDC}")
@@ -1,109 +1,318 @@
+import argparse
 import os
+import io
+import queue
+import functools
+import hashlib
 import json
+import logging
+import logging.handlers
 import re
+import shutil
+import sys
+import threading
+import time
+import traceback
 import docker
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+try:
+    import orjson  # 可选依赖: 比标准库 json 更快的解析器
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 TASKS_DIR = Path(r"INSTANCE_DIR")
 IMAGE_NAME_TEMPLATE = "swebench/sweb.eval.x86_64.INSTANCE_DIR"
+# 同时运行的验证容器数量上限；每个容器内 pytest-xdist 还会按 CPU 数启动 worker，
+# 与 dockerbuild.py 一样设上限，并把 CPU 平分给各容器 (见 process_tasks)
+MAX_WORKERS = min(os.cpu_count() or 1, 4)
+# instance_id 格式: {owner}__{repo}-{pr_id}
+# owner 取第一个 '__' 之前的部分，pr_id 取最后一个 '-' 之后的纯数字部分
+_INSTANCE_RE = re.compile(r"(.*?)__(.*)-(\d+)", re.S)
+# 实时输出容器日志的节奏: 缓冲区超过该大小或距上次输出超过该时间即写出
+LOG_FLUSH_BYTES = 64 * 1024
+LOG_FLUSH_INTERVAL = 0.2  # 秒
+# 是否在容器运行期间流式读取日志；False 时等容器退出后一次性读取 (适合 CI 批量运行)
+STREAM_LOGS = False
+LOG_QUEUE_SIZE = 1024  # 日志读取线程与写出之间最多积压的日志块数量
+# 运行日志: 控制台输出之外，同时缓冲写入脚本目录下的 verification.log
+LOG_FILE = Path(__file__).resolve().parent / "verification.log"
+LOG_BUFFER_RECORDS = 1024  # 内存中最多缓冲的日志条数，WARNING 及以上级别立即写盘
+
+log = logging.getLogger("verification")
+
+# result.json 比这些输入文件都新时，认为验证结果仍然有效
+RESULT_SOURCE_FILES = ("code.patch", "test.patch", "run_verification.py")
+# 描述测试环境的文件: 比 result.json 新时同样需要重新验证 (文件不存在时忽略)
+ENV_DEFINITION_FILES = ("Dockerfile", "setup_env.sh", "setup_repo.sh")
+# 与 result.json 同目录，记录生成该结果时使用的镜像 ID；镜像重建后结果不再视为最新
+RESULT_IMAGE_ID_FILE = "result.image_id"
+
+# --- 任务 JSON 校验规则 (模块加载时构建一次) ---
+# 必须存在的字段
+REQUIRED_FIELDS = frozenset([
+    "instance_id",
+    "patch",
+    "repo",
+    "base_commit",
+    "hints_text",
+    "created_at",
+    "test_patch",
+    "problem_statement",
+    "environment_setup_commit",
+    "FAIL_TO_PASS",
+    "PASS_TO_PASS",
+    "language",
+    "content_category",
+])
+# 允许为空的字段 (hints_text, PASS_TO_PASS)
+# 注意：FAIL_TO_PASS 不在这里，说明它不能为空
+ALLOWED_EMPTY_FIELDS = frozenset({"hints_text", "PASS_TO_PASS"})
+NONEMPTY_FIELDS = REQUIRED_FIELDS - ALLOWED_EMPTY_FIELDS
+# language 允许的值 (全部小写)
+VALID_LANGUAGES = frozenset({
+    "python",
+    "java",
+    "typescript",
+    "javascript",
+    "go",
+    "rust",
+    "c",
+    "c++",
+})
+# content_category 允许的值
+VALID_CATEGORIES = frozenset({
+    "计算",
+    "通用工具",
+    "可视化",
+    "系统",
+    "时间",
+    "网络",
+    "加密",
+    "其他",
+})
+
+
+@functools.lru_cache(maxsize=4096)
+def _split_instance_id(instance_id: str) -> tuple[str, str, str] | None:
+    """解析 instance_id 为 (owner, repo, pr_id)，owner 和 repo 转为小写；无法解析时返回 None (不输出警告)"""
+    m = _INSTANCE_RE.fullmatch(instance_id)
+    if m is None:
+        return None
+    owner, repo_name, pr_id = m.groups()
+    return owner.lower(), repo_name.lower(), pr_id
+
+
+@functools.lru_cache(maxsize=4096)
+def _image_name_for(repo_owner: str, repo_name: str, pr_id: str) -> str:
+    """根据 IMAGE_NAME_TEMPLATE 生成镜像名称 (同一镜像的多个任务只格式化一次)"""
+    return IMAGE_NAME_TEMPLATE.format(repo_owner=repo_owner, repo_name=repo_name, pr_id=pr_id)
+
+
+def _iter_task_json_files(root: str):
+    """
+    基于 os.scandir 的迭代式目录遍历，逐个返回任务 JSON 文件的 DirEntry。
+    不跟随目录符号链接 (与 Path.rglob 一致)，并直接过滤掉结果文件。
+    """
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.endswith(".json") and entry.name != "result.json":
+                        yield entry
+        except OSError:
+            continue
+
+
+def _setup_logging():
+    """配置日志输出: 控制台保持原有的纯文本格式，文件日志带时间戳和级别 (重复调用无副作用)"""
+    if log.handlers:
+        return
+    log.setLevel(logging.INFO)
+    log.propagate = False
+
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(console)
+
+    file_handler = logging.FileHandler(LOG_FILE, encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(threadName)s: %(message)s"))
+    # MemoryHandler 攒够条数或遇到 WARNING 才写盘；进程退出时由 logging.shutdown 写出剩余记录
+    log.addHandler(logging.handlers.MemoryHandler(
+        capacity=LOG_BUFFER_RECORDS,
+        flushLevel=logging.WARNING,
+        target=file_handler,
+    ))
+
+
+def _iter_with_idle_ticks(iterable, interval: float, maxsize: int = LOG_QUEUE_SIZE, name: str | None = None):
+    """
+    在后台线程中迭代 iterable 并逐个产出其元素；超过 interval 秒没有新元素时产出 None，
+    便于调用方在输出停顿期间也能按时写出已缓冲的日志。
+    调用方提前结束迭代 (异常或 break) 时通知后台线程停止，后台线程不会阻塞在已满的队列上。
+    """
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    end = object()  # 结束标记
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=interval)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def pump():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((end, e))
+            return
+        put((end, None))
+
+    threading.Thread(target=pump, name=name, daemon=True).start()
+    try:
+        while True:
+            try:
+                item, error = items.get(timeout=interval)
+            except queue.Empty:
+                yield None
+                continue
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def _result_is_fresh(task_dir: Path, image_id: str | None) -> bool:
+    """
+    result.json 存在、由当前镜像 (image_id) 生成，且不早于所有输入文件和环境定义文件时返回 True。
+    任一输入文件缺失或没有镜像 ID 记录时视为需要重新验证；环境定义文件缺失时忽略该文件
+    """
+    try:
+        result_mtime = (task_dir / "result.json").stat().st_mtime
+        source_mtime = max((task_dir / name).stat().st_mtime for name in RESULT_SOURCE_FILES)
+        recorded_image_id = (task_dir / RESULT_IMAGE_ID_FILE).read_text(encoding="utf-8").strip()
+    except OSError:
+        return False
+    if image_id is None or recorded_image_id != image_id or result_mtime < source_mtime:
+        return False
+    for name in ENV_DEFINITION_FILES:
+        try:
+            if (task_dir / name).stat().st_mtime > result_mtime:
+                return False
+        except OSError:
+            continue
+    return True
+
+
+def _task_fingerprint(task_dir: Path, image_id: str) -> str | None:
+    """
+    根据镜像 ID 和 RESULT_SOURCE_FILES 的内容计算验证任务的指纹 (sha256)，
+    指纹相同的任务验证结果必然相同；任一输入文件无法读取时返回 None (不参与去重)
+    """
+    h = hashlib.sha256(image_id.encode())
+    try:
+        for name in RESULT_SOURCE_FILES:
+            data = (task_dir / name).read_bytes()
+            # 写入长度前缀，避免不同文件内容拼接后产生相同的字节序列
+            h.update(len(data).to_bytes(8, "little"))
+            h.update(data)
+    except OSError:
+        return None
+    return h.hexdigest()
 
 
 class DockerImageManager:
-    def __init__(self):
+    def __init__(self, max_workers: int = MAX_WORKERS, stream_logs: bool = STREAM_LOGS):
+        self.max_workers = max(1, max_workers)
+        self.stream_logs = stream_logs
+        self._log_lock = threading.Lock()
+        self._image_cache: dict[str, str | None] = {}  # 镜像名称 -> 镜像 ID (不存在时为 None)
         try:
             self.client = docker.from_env()
             self.client.ping()
-            print("✅ 成功连接到 Docker 服务。")
+            # 底层 API 客户端，复用同一连接直接创建/启动/等待容器
+            self.api = self.client.api
+            log.info("✅ 成功连接到 Docker 服务。")
         except Exception as e:
-            print(f"❌ 错误: 无法连接到 Docker 服务。请确保 Docker 正在运行。")
-            print(f"   详细信息: {e}")
+            log.error(f"❌ 错误: 无法连接到 Docker 服务。请确保 Docker 正在运行。\n   详细信息: {e}")
             exit(1)
 
+    def _log(self, text: str):
+        """将一段日志作为单条记录输出 (整段写出，避免并行验证时不同任务的日志交错)"""
+        if not text:
+            return
+        log.info(text.rstrip("\n"))
+
+    def _log_bytes(self, data: bytes):
+        """线程安全地将原始字节直接写入标准输出 (避免逐块解码)"""
+        if not data:
+            return
+        with self._log_lock:
+            sys.stdout.flush()
+            stdout_buffer = getattr(sys.stdout, "buffer", None)
+            if stdout_buffer is not None:
+                stdout_buffer.write(data)
+                stdout_buffer.flush()
+            else:
+                sys.stdout.write(data.decode("utf-8", "replace"))
+                sys.stdout.flush()
+
+    def _flush_buffer(self, out: io.StringIO):
+        """写出缓冲区中已有的日志并清空缓冲区"""
+        self._log(out.getvalue())
+        out.seek(0)
+        out.truncate()
+
     def parse_instance_id(self, instance_id: str) -> dict | None:
-        try:
-            # 1. 先从【最右边】切一刀，以 '-' 分隔。
-            # rsplit('-', 1) 表示从右往左切，只切 1 次。
-            # 这样无论 Repo 名字里有多少个 '-'，我们都能精准拿到最后的 PR ID
-            repo_part, pr_id = instance_id.rsplit('-', 1)
-            
-            # 验证切出来的 PR ID 是不是纯数字
-            if not pr_id.isdigit():
-                raise ValueError("PR ID 不是数字")
-
-            # 2. 再从【最左边】切一刀，以 '__' 分隔。
-            # split('__', 1) 表示从左往右切，只切 1 次。
-            # 这样无论 Repo 名字里有没有 '__'，我们都认为第一个 '__' 之前的是 Owner
-            owner, repo_name = repo_part.split('__', 1)
-
-            return {
-                "repo_owner": owner,
-                "repo_name": repo_name,
-                "pr_id": pr_id,
-            }
-        except ValueError:
-            # 如果分割失败（找不到 '-' 或 '__'），或者解包数量不对，会抛出 ValueError
-            print(f"⚠️ 警告: 无法解析 instance_id '{instance_id}'。格式严重不匹配。")
+        parts = _split_instance_id(instance_id)
+        if parts is None:
+            log.warning(f"⚠️ 警告: 无法解析 instance_id '{instance_id}'。格式严重不匹配。")
             return None
+        owner, repo_name, pr_id = parts
+        return {
+            "repo_owner": owner,
+            "repo_name": repo_name,
+            "pr_id": pr_id,
+        }
 
     def validate_task_data(self, data: dict, filename: str) -> bool:
         """
         校验 JSON 数据字段是否符合要求
         """
-        # 1. 定义必须存在的字段
-        required_fields = [
-            "instance_id",
-            "patch",
-            "repo",
-            "base_commit",
-            "hints_text",
-            "created_at",
-            "test_patch",
-            "problem_statement",
-            "environment_setup_commit",
-            "FAIL_TO_PASS",
-            "PASS_TO_PASS",
-            "language",
-            "content_category",
-        ]
-
-        # 2. 定义允许为空的字段 (hints_text, PASS_TO_PASS)
-        #    注意：FAIL_TO_PASS 不在这里，说明它不能为空
-        allowed_empty_fields = {"hints_text", "PASS_TO_PASS"}
-
         # --- 基础字段存在性与非空校验 ---
-        for field in required_fields:
-            if field not in data:
-                print(f"   ❌ [校验失败] {filename}: 缺少必须字段 '{field}'")
-                return False
+        missing_fields = REQUIRED_FIELDS - data.keys()
+        if missing_fields:
+            names = ", ".join(f"'{field}'" for field in sorted(missing_fields))
+            log.error(f"   ❌ [校验失败] {filename}: 缺少必须字段 {names}")
+            return False
 
-            value = data[field]
-
-            # 如果不在允许为空的列表中，则进行非空检查
-            if field not in allowed_empty_fields:
-                if value is None:
-                    print(
-                        f"   ❌ [校验失败] {filename}: 字段 '{field}' 不能为空 (None)"
-                    )
-                    return False
-                if isinstance(value, (str, list, dict)) and len(value) == 0:
-                    print(
-                        f"   ❌ [校验失败] {filename}: 字段 '{field}' 不能为空 (长度为0)"
-                    )
-                    return False
+        # 不允许为空的字段: 值为 None，或为长度为 0 的 str/list/dict
+        empty_fields = sorted(
+            field for field in NONEMPTY_FIELDS
+            if data[field] is None
+            or (isinstance(data[field], (str, list, dict)) and len(data[field]) == 0)
+        )
+        if empty_fields:
+            names = ", ".join(f"'{field}'" for field in empty_fields)
+            log.error(f"   ❌ [校验失败] {filename}: 字段 {names} 不能为空 (None 或长度为0)")
+            return False
 
         # --- Language 校验 ---
-        # 允许的值 (全部小写)
-        valid_languages = {
-            "python",
-            "java",
-            "typescript",
-            "javascript",
-            "go",
-            "rust",
-            "c",
-            "c++",
-        }
-
         lang_val = data["language"]
         # 统一转为列表处理 (支持 str 或 list)
         langs_to_check = (
@@ -114,32 +323,21 @@ class DockerImageManager:
 
         # 再次确认是否有值 (虽然前面非空校验过，但防一手 list 中包含空字符串等情况)
         if not langs_to_check:
-            print(f"   ❌ [校验失败] {filename}: language 字段格式无效")
+            log.error(f"   ❌ [校验失败] {filename}: language 字段格式无效")
             return False
 
-        for l in langs_to_check:
-            if not isinstance(l, str):
-                print(f"   ❌ [校验失败] {filename}: language 包含非字符串类型")
-                return False
-            if l.lower() not in valid_languages:
-                print(
-                    f"   ❌ [校验失败] {filename}: language '{l}' 无效。允许值: {valid_languages}"
-                )
-                return False
+        # 不用 "集合长度 != 列表长度" 判断非字符串元素: 重复的语言 (如 "Python", "python") 会被误判
+        if not all(isinstance(l, str) for l in langs_to_check):
+            log.error(f"   ❌ [校验失败] {filename}: language 包含非字符串类型")
+            return False
+        invalid_langs = {l.lower() for l in langs_to_check} - VALID_LANGUAGES
+        if invalid_langs:
+            log.error(
+                f"   ❌ [校验失败] {filename}: language {sorted(invalid_langs)} 无效。允许值: {sorted(VALID_LANGUAGES)}"
+            )
+            return False
 
         # --- Content Category 校验 ---
-        # 允许的值
-        valid_categories = {
-            "计算",
-            "通用工具",
-            "可视化",
-            "系统",
-            "时间",
-            "网络",
-            "加密",
-            "其他"
-        }
-
         cat_val = data["content_category"]
         # 统一转为列表处理 (支持 str 或 list)
         cats_to_check = (
@@ -149,147 +347,213 @@ class DockerImageManager:
         )
 
         if not cats_to_check:
-            print(f"   ❌ [校验失败] {filename}: content_category 字段格式无效")
+            log.error(f"   ❌ [校验失败] {filename}: content_category 字段格式无效")
             return False
 
-        for c in cats_to_check:
-            if not isinstance(c, str):
-                print(f"   ❌ [校验失败] {filename}: content_category 包含非字符串类型")
-                return False
-            if c not in valid_categories:
-                print(
-                    f"   ❌ [校验失败] {filename}: content_category '{c}' 无效。允许值: {valid_categories}"
-                )
-                return False
+        if not all(isinstance(c, str) for c in cats_to_check):
+            log.error(f"   ❌ [校验失败] {filename}: content_category 包含非字符串类型")
+            return False
+        invalid_cats = set(cats_to_check) - VALID_CATEGORIES
+        if invalid_cats:
+            log.error(
+                f"   ❌ [校验失败] {filename}: content_category {sorted(invalid_cats)} 无效。允许值: {sorted(VALID_CATEGORIES)}"
+            )
+            return False
 
         return True
 
+    def _probe_image(self, image_name: str) -> str | None:
+        """用底层 API inspect_image 查询镜像 ID，不构造高层 Image 对象"""
+        try:
+            return self.api.inspect_image(image_name)["Id"]
+        except docker.errors.NotFound:
+            return None
+
+    def get_image_id(self, image_name: str) -> str | None:
+        """返回镜像 ID (镜像不存在时为 None)，每个镜像只向 Docker 服务查询一次"""
+        if image_name not in self._image_cache:
+            self._image_cache[image_name] = self._probe_image(image_name)
+        return self._image_cache[image_name]
+
     def check_image_exists(self, image_name: str) -> bool:
+        return self.get_image_id(image_name) is not None
+
+    def _stream_logs(self, container_id: str, instance_id: str, log_path: Path, live_output: bool):
+        """容器运行期间流式读取日志，写入 log_path；live_output=True 时按批同时输出到终端"""
+        stream = self.api.logs(container_id, stream=True, follow=True)
+        pending = bytearray()  # 尚未输出到终端的日志
+        last_flush = time.monotonic()
         try:
-            self.client.images.get(image_name)
-            return True
-        except docker.errors.ImageNotFound:
-            return False
+            with open(log_path, "wb", buffering=LOG_FLUSH_BYTES) as log_file:
+                # 后台线程读取日志流，当前线程只负责写文件/终端；暂无新日志时产出 None
+                for chunk in _iter_with_idle_ticks(stream, LOG_FLUSH_INTERVAL, name=f"logs-{instance_id}"):
+                    if chunk is not None:
+                        log_file.write(chunk)
+                        if live_output:
+                            pending += chunk
+                    now = time.monotonic()
+                    if pending and (chunk is None or len(pending) >= LOG_FLUSH_BYTES
+                                    or now - last_flush >= LOG_FLUSH_INTERVAL):
+                        self._log_bytes(pending)
+                        pending.clear()
+                        last_flush = now
+        finally:
+            # 写出端出错提前退出时关闭日志流，读取线程随之结束，不会一直占用连接
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+        self._log_bytes(pending)
+
+    def run_validation(self, json_file_path: Path, image_name: str, instance_id: str, live_output: bool = True,
+                       no_cache: bool = False, xdist_workers: int | None = None):
+        """
+        运行验证容器,将任务目录挂载到容器的 /testbed_output，并在 /testbed 下执行其中的 run_verification.py
+        容器输出始终写入任务目录下的 container.log；
+        live_output=True 时同时输出到终端 (stream_logs=False 时在容器退出后一次性输出)，否则任务日志在结束后整段输出
+        no_cache=True 时 run_verification.py 不使用补丁前测试结果缓存
+        xdist_workers: 容器内 pytest-xdist 的 worker 数 (None 时由 run_verification.py 自行决定)
+        """
+        out = io.StringIO()
+        try:
+            self._run_validation(json_file_path, image_name, instance_id, live_output, no_cache, xdist_workers, out)
+        finally:
+            self._log(out.getvalue())
 
-    def run_validation(self, json_file_path: Path, image_name: str, instance_id: str):
-        """运行验证容器,分别挂载每个文件到容器的 /testbed"""
-        print(f"   -> 🚀 开始运行验证: {instance_id}")
+    def _run_validation(self, json_file_path: Path, image_name: str, instance_id: str, live_output: bool,
+                        no_cache: bool, xdist_workers: int | None, out: io.StringIO):
+        print(f"   -> 🚀 开始运行验证: {instance_id}", file=out)
         source_dir = json_file_path.parent.absolute()
 
-        print(f"   -> 源目录: {source_dir}")
-        print(f"   -> 目录中的文件:")
+        print(f"   -> 源目录: {source_dir}", file=out)
+        print(f"   -> 目录中的文件:", file=out)
         for item in source_dir.iterdir():
-            print(f"      - {item.name}")
-
-        # 准备要挂载的文件
-        files_to_mount = {
-            "run_verification.py": source_dir / "run_verification.py",
-            "test.patch": source_dir / "test.patch",
-            "code.patch": source_dir / "code.patch",
-        }
+            print(f"      - {item.name}", file=out)
 
-        # 构建 volumes 字典 - 分别挂载每个文件
-        volumes = {}
-        for target_name, source_path in files_to_mount.items():
-            if source_path.exists():
-                volumes[str(source_path)] = {
-                    "bind": f"/testbed/{target_name}",
-                    "mode": "rw",
-                }
-                print(f"   -> 将挂载: {source_path.name} -> /testbed/{target_name}")
-            else:
-                print(f"   -> ⚠️ 文件不存在,跳过: {target_name}")
-
-        # 挂载输出目录 - 改为当前任务目录
+        # 整个任务目录只挂载一次 ("宿主机路径:容器路径:模式")：
+        # run_verification.py / test.patch / code.patch 直接从 /testbed_output 读取，结果也写回该目录。
+        # 不能挂载到 /testbed，否则会遮住镜像中已有的仓库 (/testbed/{repo})
         output_dir = source_dir
-        volumes[str(output_dir)] = {"bind": "/testbed_output", "mode": "rw"}
-        print(f"   -> 输出目录挂载: {output_dir} -> /testbed_output")
+        binds = [f"{output_dir}:/testbed_output:rw"]
+        print(f"   -> 任务目录挂载: {output_dir} -> /testbed_output", file=out)
 
         result_file_path = output_dir / "result.json"
         if result_file_path.exists():
             try:
                 os.remove(result_file_path)
-                print(f"   -> 🗑️ 已清理旧的结果文件: {result_file_path.name}")
+                print(f"   -> 🗑️ 已清理旧的结果文件: {result_file_path.name}", file=out)
             except OSError as e:
-                print(f"   -> ⚠️ 警告: 无法删除旧结果文件: {e}")
+                print(f"   -> ⚠️ 警告: 无法删除旧结果文件: {e}", file=out)
+        container_id = None
         try:
-            print(f"   -> 启动容器 (镜像: {image_name})...")
-
-            container = self.client.containers.run(
-                image_name,
+            print(f"   -> 启动容器 (镜像: {image_name})...", file=out)
+
+            image_id = self.get_image_id(image_name)
+            # 镜像 ID 纳入 run_verification.py 补丁前缓存的键，镜像重建后缓存自动失效
+            environment = {"INSTANCE_ID": instance_id, "VERIFICATION_IMAGE_ID": image_id or image_name}
+            if no_cache:
+                environment["VERIFICATION_NO_CACHE"] = "1"
+            if xdist_workers is not None:
+                environment["VERIFICATION_XDIST_WORKERS"] = str(xdist_workers)
+
+            # 使用底层 API 直接按镜像 ID 创建并启动容器，省去按名称解析镜像
+            container_id = self.api.create_container(
+                image=image_id or image_name,
                 # 关键点：在 -c 前面加上 -i
-                command="/bin/bash -i -c 'cd /testbed && python run_verification.py && cp -f results.json /testbed_output/result.json 2>/dev/null || true'",
-                volumes=volumes,
-                network_mode="none",
-                environment={"INSTANCE_ID": instance_id},
-                remove=True,
-                detach=True,
+                # 成功时将 results.json 改名为 result.json；失败时删除，不在宿主机任务目录中留下中间文件。
+                # 只屏蔽 mv/rm 的错误输出，脚本自身的 stderr (如未捕获异常的堆栈) 仍进入容器日志
+                command="/bin/bash -i -c 'cd /testbed && if python /testbed_output/run_verification.py; then mv -f /testbed_output/results.json /testbed_output/result.json 2>/dev/null; else rm -f /testbed_output/results.json 2>/dev/null; fi; true'",
+                environment=environment,
                 # 建议加上 tty=True，防止 bash 抱怨没有终端
                 tty=True,
                 working_dir="/testbed",
-            )
-            # 流式日志
-            for chunk in container.logs(stream=True, follow=True):
-                print(chunk.decode("utf-8", "replace"), end="")
+                host_config=self.api.create_host_config(binds=binds, network_mode="none"),
+            )["Id"]
+            self.api.start(container_id)
+            # 容器日志写入 container.log，实时模式下同时输出到终端
+            log_path = output_dir / "container.log"
+            print(f"   -> 容器日志: {log_path}", file=out)
+            if live_output:
+                self._flush_buffer(out)
+            if self.stream_logs:
+                self._stream_logs(container_id, instance_id, log_path, live_output)
+                ret = self.api.wait(container_id)
+            else:
+                # 批量模式: 等待容器退出后一次性读取全部日志 (容器在 finally 中才删除，退出后日志仍可读取)
+                ret = self.api.wait(container_id)
+                logs = self.api.logs(container_id, stream=False)
+                log_path.write_bytes(logs)
+                if live_output:
+                    self._log_bytes(logs)
 
-            ret = container.wait()
             exit_code = ret.get("StatusCode", 1)
-            print(f"\n[容器退出码] {exit_code}")
-            # logs = container.decode("utf-8")
-            # print("   --- 容器日志 START ---")
-            # print(logs)
-            # print("   --- 容器日志 END ---")
+            print(f"\n[容器退出码] {exit_code}", file=out)
 
             # 检查结果文件
             result_file = output_dir / "result.json"
             if result_file.exists():
-                print(f"   -> ✅ 验证完成,结果文件已生成: {result_file}")
+                print(f"   -> ✅ 验证完成,结果文件已生成: {result_file}", file=out)
+                # 记录生成结果的镜像，供下次运行判断结果是否最新
+                if image_id is not None:
+                    try:
+                        (output_dir / RESULT_IMAGE_ID_FILE).write_text(image_id, encoding="utf-8")
+                    except OSError as e:
+                        print(f"   -> ⚠️ 警告: 无法记录结果对应的镜像 ID: {e}", file=out)
             else:
-                print(f"   -> ❌ 错误: 容器运行完毕,但未生成结果文件")
-                print(f"   -> 目录内容:")
+                print(f"   -> ❌ 错误: 容器运行完毕,但未生成结果文件", file=out)
+                print(f"   -> 目录内容:", file=out)
                 for item in output_dir.iterdir():
-                    print(f"      - {item.name}")
-
-        except docker.errors.ContainerError as e:
-            print(f"   -> ❌ 错误: 容器运行异常退出")
-            print(f"   -> 退出码: {e.exit_status}")
-            print(f"   -> 错误详情: {str(e)}")
+                    print(f"      - {item.name}", file=out)
 
         except Exception as e:
-            print(f"   -> ❌ 运行容器时发生未知错误: {e}")
-            import traceback
-
-            traceback.print_exc()
-
-    def process_tasks(self, tasks_dir: Path):
+            print(f"   -> ❌ 运行容器时发生未知错误: {e}", file=out)
+            traceback.print_exc(file=out)
+
+        finally:
+            # 容器结束后删除 (代替 auto_remove，避免 wait 时容器已被自动删除)
+            if container_id is not None:
+                try:
+                    self.api.remove_container(container_id, force=True)
+                except docker.errors.APIError as e:
+                    print(f"   -> ⚠️ 警告: 无法删除容器 {container_id[:12]}: {e}", file=out)
+
+    def process_tasks(self, tasks_dir: Path, force: bool = False):
+        """
+        扫描并校验所有任务，再并行运行验证容器
+        force=False 时跳过已有最新 result.json 的任务；force=True 时还会让容器内忽略补丁前测试结果缓存
+        """
         if not tasks_dir.is_dir():
-            print(f"❌ 错误: 任务目录 '{tasks_dir}' 不存在。")
+            log.error(f"❌ 错误: 任务目录 '{tasks_dir}' 不存在。")
             return
 
-        print(f"\n🔍 开始扫描目录: {tasks_dir}")
+        log.info(f"\n🔍 开始扫描目录: {tasks_dir}")
         processed_images = set()
+        tasks = []  # 待验证的 (json_file, image_name, instance_id)
+        primary_dirs = {}  # 任务指纹 -> 实际运行验证的任务目录
+        duplicates = []  # 无需重复运行的 (实际运行的任务目录, 复用其结果的任务目录)
+
+        for entry in _iter_task_json_files(str(tasks_dir)):
+            # 文件名约定为 "{instance_id}.json"：先从文件名判断，
+            # 文件名不是合法 instance_id 的 JSON 文件无需解析
+            candidate_id = entry.name[:-len(".json")]
+            if _split_instance_id(candidate_id) is None:
+                continue
 
-        for json_file in tasks_dir.rglob("*.json"):
-            # 1. 读取 JSON
+            json_file = Path(entry.path)
+            # 1. 读取 JSON (orjson.JSONDecodeError 是 json.JSONDecodeError 的子类)
             try:
-                with open(json_file, "r", encoding="utf-8") as f:
-                    data = json.load(f)
+                data = _json_loads(json_file.read_bytes())
             except json.JSONDecodeError:
-                print(f"   -> ⚠️ 跳过无效 JSON 文件: {json_file.name}")
+                log.warning(f"   -> ⚠️ 跳过无效 JSON 文件: {json_file.name}")
                 continue
             except Exception as e:
-                print(f"🚨 读取文件 '{json_file}' 时发生错误: {e}")
+                log.error(f"🚨 读取文件 '{json_file}' 时发生错误: {e}")
                 continue
 
             # 2. 检查 instance_id 并验证文件名
             instance_id = data.get("instance_id")
             
-            # 如果 JSON 中没有 instance_id，或者文件名不等于 "{instance_id}.json"，则跳过
-            if not instance_id:
-                continue
-            
-            expected_filename = f"{instance_id}.json"
-            if json_file.name != expected_filename:
+            # 如果 JSON 中的 instance_id 与文件名 "{instance_id}.json" 不一致，则跳过
+            if instance_id != candidate_id:
                 continue
 
             # 3. 文件名匹配成功后，再进行严格的字段格式校验
@@ -300,42 +564,85 @@ class DockerImageManager:
             parsed_info = self.parse_instance_id(instance_id)
             if not parsed_info:
                 continue
-            parsed_info_lower = {
-                    "repo_owner": parsed_info["repo_owner"].lower(),
-                    "repo_name": parsed_info["repo_name"].lower(),
-                    "pr_id": parsed_info["pr_id"]
-            }
-            image_name = IMAGE_NAME_TEMPLATE.format(**parsed_info_lower)
+            image_name = _image_name_for(**parsed_info)
+
+            if not force and _result_is_fresh(json_file.parent, self.get_image_id(image_name)):
+                log.info(f"   -> ⏭️ 跳过 {instance_id}: result.json 已是最新 (使用 --force 强制重新验证)")
+                continue
 
             if image_name not in processed_images:
                 processed_images.add(image_name)
-                print(f"\n{'='*60}")
-                print(f"镜像: {image_name}")
-                print(f"任务: {instance_id}")
-                print(f"文件: {json_file.name}")
-                print(f"{'='*60}")
+                log.info(
+                    f"\n{'='*60}\n"
+                    f"镜像: {image_name}\n"
+                    f"任务: {instance_id}\n"
+                    f"文件: {json_file.name}\n"
+                    f"{'='*60}"
+                )
 
                 if not self.check_image_exists(image_name):
-                    print(f"   ❌ 镜像不存在，跳过此任务")
+                    log.error(f"   ❌ 镜像不存在，跳过此任务")
                     continue
 
-                print(f"   ✅ 镜像已存在")
-
-            # 运行验证
-            if self.check_image_exists(image_name):
-                self.run_validation(json_file, image_name, instance_id)
-            else:
-                print(f"   -> ⚠️ 跳过验证: 镜像不存在")
-
-        print(f"\n{'='*60}")
-        print(f"✅ 扫描完成,共处理 {len(processed_images)} 个镜像")
-        print(f"{'='*60}")
+                log.info(f"   ✅ 镜像已存在")
+            elif not self.check_image_exists(image_name):
+                log.warning(f"   -> ⚠️ 跳过验证: 镜像不存在")
+                continue
 
+            # 镜像和输入文件完全相同的任务只运行一次，其余任务复用结果
+            task_dir = json_file.parent
+            fingerprint = _task_fingerprint(task_dir, self.get_image_id(image_name))
+            if fingerprint is not None:
+                if fingerprint in primary_dirs:
+                    log.info(f"   -> ♻️ 跳过 {instance_id}: 与 {primary_dirs[fingerprint].name} 的镜像和输入文件完全相同，将复用其结果")
+                    duplicates.append((primary_dirs[fingerprint], task_dir))
+                    # 旧结果已判定为过期，先删除；主任务没有生成结果时不会留下过期的 result.json
+                    for name in ("result.json", RESULT_IMAGE_ID_FILE):
+                        try:
+                            (task_dir / name).unlink(missing_ok=True)
+                        except OSError as e:
+                            log.warning(f"   -> ⚠️ 警告: 无法删除旧结果文件 {task_dir / name}: {e}")
+                    continue
+                primary_dirs[fingerprint] = task_dir
 
-def verify():
+            # 运行验证
+            tasks.append((json_file, image_name, instance_id))
+
+        # 并行运行验证容器；只有一个容器在运行时实时输出容器日志
+        if tasks:
+            workers = min(self.max_workers, len(tasks))
+            live_output = workers == 1
+            # 多个容器同时运行时平分 CPU，避免每个容器的 pytest-xdist 都按全部 CPU 启动 worker
+            xdist_workers = max(1, (os.cpu_count() or 1) // workers) if workers > 1 else None
+            log.info(f"\n🚀 开始运行 {len(tasks)} 个验证任务 (并行数: {workers})")
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(self.run_validation, json_file, image_name, instance_id, live_output, force,
+                                    xdist_workers)
+                    for json_file, image_name, instance_id in tasks
+                ]
+                for future in as_completed(futures):
+                    future.result()
+
+            for primary_dir, task_dir in duplicates:
+                try:
+                    shutil.copyfile(primary_dir / "result.json", task_dir / "result.json")
+                    shutil.copyfile(primary_dir / RESULT_IMAGE_ID_FILE, task_dir / RESULT_IMAGE_ID_FILE)
+                    log.info(f"   -> 📋 已复用 {primary_dir.name} 的结果: {task_dir / 'result.json'}")
+                except OSError as e:
+                    log.warning(f"   -> ⚠️ 无法为 {task_dir.name} 复用结果文件: {e}")
+
+        log.info(f"\n{'='*60}\n✅ 扫描完成,共处理 {len(processed_images)} 个镜像\n{'='*60}")
+
+
+def verify(force: bool = False):
+    _setup_logging()
     manager = DockerImageManager()
-    manager.process_tasks(TASKS_DIR)
+    manager.process_tasks(TASKS_DIR, force=force)
 
 
 if __name__ == "__main__":
-    verify()
+    parser = argparse.ArgumentParser(description="在验证镜像中运行各任务的 run_verification.py")
+    parser.add_argument("--force", action="store_true", help="忽略已有的 result.json 和补丁前测试结果缓存，重新验证所有任务")
+    args = parser.parse_args()
+    verify(force=args.force)
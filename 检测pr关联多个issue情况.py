@@ -1,4 +1,46 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+GITHUB_GRAPHQL_URL = 'https://api.github.com/graphql'
+# (连接超时, 读取超时)，单位: 秒
+REQUEST_TIMEOUT = (5, 30)
+
+# 模块级 Session: 复用 TCP/TLS 连接，多次请求无需重复握手
+_SESSION = requests.Session()
+_SESSION.headers.update({"Accept": "application/json"})
+# 连接池 + 对网关错误自动重试 (GraphQL 查询是只读的，POST 可以安全重试)
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=frozenset(["POST"]),
+        # 重试用尽后返回最后一次响应而不是抛出 RetryError，交给 HTTP 状态码分支处理
+        raise_on_status=False,
+    ),
+))
+
+# 查询单个 PR 关闭的 Issue 的 GraphQL 片段，单个查询与批量查询共用 (alias 为结果中的键名)
+CLOSING_ISSUES_FRAGMENT = """
+      %(alias)s: repository(owner: "%(owner)s", name: "%(repo_name)s") {
+        pullRequest(number: %(pr_number)d) {
+          closingIssuesReferences(first: 10) {
+            totalCount
+            nodes {
+              number
+              url
+            }
+          }
+        }
+      }"""
+
+
+def _build_closing_issues_query(fragments):
+    """将若干 CLOSING_ISSUES_FRAGMENT 片段组合为一个完整的 GraphQL 查询"""
+    return "query {%s\n    }" % "".join(fragments)
 
 
 def get_pr_closing_issues(token, repo_full_name, pr_number):
@@ -18,24 +60,15 @@ def get_pr_closing_issues(token, repo_full_name, pr_number):
         print("❌ 仓库名称格式错误，应为 'Owner/Repo' 格式")
         return None
     
-    query = """
-    query {
-      repository(owner: "%s", name: "%s") {
-        pullRequest(number: %d) {
-          closingIssuesReferences(first: 10) {
-            totalCount
-            nodes {
-              number
-              url
-            }
-          }
-        }
-      }
-    }
-    """ % (owner, repo_name, pr_number)
+    query = _build_closing_issues_query([CLOSING_ISSUES_FRAGMENT % {
+        "alias": "repository",
+        "owner": owner,
+        "repo_name": repo_name,
+        "pr_number": pr_number,
+    }])
 
     try:
-        response = requests.post('https://api.github.com/graphql', json={'query': query}, headers=headers)
+        response = _SESSION.post(GITHUB_GRAPHQL_URL, json={'query': query}, headers=headers, timeout=REQUEST_TIMEOUT)
         
         # 检查 HTTP 状态码
         if response.status_code != 200:
@@ -61,6 +94,63 @@ def get_pr_closing_issues(token, repo_full_name, pr_number):
 
 
 
+def get_pr_closing_issues_batch(token, queries):
+    """
+    批量查询多个 PR 关联并关闭的 Issue 列表，所有 PR 合并为一次 GraphQL 请求 (使用别名 q0, q1, ...)。
+    
+    :param token: GitHub Personal Access Token
+    :param queries: (仓库全名, PR 编号) 的列表，例如 [('Flexget/Flexget', 1), ('aesara-devs/aesara', 1493)]
+    :return: {(仓库全名, PR 编号): 包含 totalCount 和 nodes 的字典}，
+             单个 PR 查询失败时对应的值为 None；整个请求失败时返回 None
+    """
+    if not queries:
+        return {}
+
+    headers = {"Authorization": f"Bearer {token}"}
+
+    fragments = []
+    for i, (repo_full_name, pr_number) in enumerate(queries):
+        try:
+            owner, repo_name = repo_full_name.split('/')
+        except ValueError:
+            print(f"❌ 仓库名称格式错误，应为 'Owner/Repo' 格式: {repo_full_name}")
+            return None
+        fragments.append(CLOSING_ISSUES_FRAGMENT % {
+            "alias": f"q{i}",
+            "owner": owner,
+            "repo_name": repo_name,
+            "pr_number": pr_number,
+        })
+
+    query = _build_closing_issues_query(fragments)
+
+    try:
+        response = _SESSION.post(GITHUB_GRAPHQL_URL, json={'query': query}, headers=headers, timeout=REQUEST_TIMEOUT)
+        
+        # 检查 HTTP 状态码
+        if response.status_code != 200:
+            print(f"❌ 请求失败，HTTP 状态码: {response.status_code}")
+            return None
+            
+        data = response.json()
+        
+        # 部分 PR 不存在或无权限时 GraphQL 会返回 errors，其余 PR 的结果仍然可用
+        if 'errors' in data:
+            print("⚠️ GraphQL 查询返回错误:", data['errors'])
+
+        # 按别名取回每个 PR 的结果
+        payload = data.get('data') or {}
+        results = {}
+        for i, key in enumerate(queries):
+            repository = payload.get(f"q{i}")
+            pull_request = repository.get('pullRequest') if repository else None
+            results[tuple(key)] = pull_request['closingIssuesReferences'] if pull_request else None
+        return results
+
+    except Exception as e:
+        print(f"❌ 发生未知错误: {e}")
+        return None
+
 
 if __name__ == "__main__":
     token = ""